@@ -2,15 +2,24 @@ print("Bot ne shuru kar diya!")
 
 import os
 import io
+import ast
+import atexit
 import re
 import json
 import time
-import base64
 import datetime
 import logging
+import operator
 import asyncio
-import requests
-import numexpr
+import contextlib
+import concurrent.futures
+import tempfile
+import threading
+from collections import defaultdict
+import aiohttp
+import ijson
+import orjson
+import pybase64
 from dotenv import load_dotenv
 
 from flask import Flask, request as flask_request
@@ -38,6 +47,15 @@ ADMIN_USER_IDS = set([s.strip() for s in (os.getenv("ADMIN_USER_IDS") or "").spl
 COOLDOWN_SECONDS = int(os.getenv("COOLDOWN_SECONDS", "5"))
 DEFAULT_DAILY_LIMIT = int(os.getenv("DEFAULT_DAILY_LIMIT", "10"))
 DEFAULT_MONTHLY_CAP = int(os.getenv("MONTHLY_GLOBAL_CAP", "100"))
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "0.2"))
+USAGE_BATCH_MAX_PATHS = 450
+USAGE_RETRY_MAX_DELAY = 30
+FB_CONCURRENCY = int(os.getenv("FB_CONCURRENCY", "32"))
+VERTEX_CONCURRENCY = int(os.getenv("VERTEX_CONCURRENCY", "4"))
+STARTUP_TIMEOUT = 30
+WEBHOOK_TIMEOUT = 55
+# Outbound calls give up well before the webhook does, so updates finish before the response
+HTTP_TIMEOUT = 45
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
@@ -45,144 +63,355 @@ logger = logging.getLogger(__name__)
 # ---------------- Initialize Firebase ----------------
 FIREBASE_READY = False
 try:
-    if not firebase_admin._apps:
-        if FIREBASE_CREDS_JSON and FIREBASE_DB_URL:
-            cred_dict = json.loads(FIREBASE_CREDS_JSON)
-            cred = credentials.Certificate(cred_dict)
+    if FIREBASE_CREDS_JSON and FIREBASE_DB_URL:
+        if not firebase_admin._apps:
+            cred = credentials.Certificate(json.loads(FIREBASE_CREDS_JSON))
             firebase_admin.initialize_app(cred, {"databaseURL": FIREBASE_DB_URL})
-            FIREBASE_READY = True
             logger.info("Firebase initialized from FIREBASE_CREDS_JSON")
+        FIREBASE_READY = True
 except Exception as e:
     logger.exception("Firebase init failed: %s", e)
     FIREBASE_READY = False
 
+# ---------------- Shared HTTP session ----------------
+_SESSION: aiohttp.ClientSession | None = None
+
+async def _session():
+    # Only ever called on LOOP, so one session serves the whole process
+    global _SESSION
+    if _SESSION is None or _SESSION.closed:
+        connector = aiohttp.TCPConnector(limit=100, limit_per_host=32, keepalive_timeout=30, ttl_dns_cache=300)
+        _SESSION = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT))
+    return _SESSION
+
 # ---------------- Async requests helpers ----------------
+# Per-destination caps on in-flight requests
+_FB_SEM = asyncio.Semaphore(FB_CONCURRENCY)
+_VERTEX_SEM = asyncio.Semaphore(VERTEX_CONCURRENCY)
+
+def _limit_for(url: str):
+    if FIREBASE_DB_URL and url.startswith(FIREBASE_DB_URL):
+        return _FB_SEM
+    if "aiplatform.googleapis.com" in url:
+        return _VERTEX_SEM
+    return contextlib.nullcontext()
+
+@contextlib.asynccontextmanager
+async def _async_stream(method: str, url: str, **kwargs):
+    if "json" in kwargs:
+        kwargs["data"] = orjson.dumps(kwargs.pop("json"))
+        kwargs["headers"] = {**(kwargs.get("headers") or {}), "Content-Type": "application/json"}
+    async with _limit_for(url):
+        async with (await _session()).request(method, url, **kwargs) as resp:
+            yield resp
+
+async def _async_request(method: str, url: str, **kwargs):
+    async with _async_stream(method, url, **kwargs) as resp:
+        raw = await resp.read()
+        return resp.status, orjson.loads(raw) if raw else None
+
 async def _async_post(url: str, **kwargs):
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, lambda: requests.post(url, **kwargs))
+    return await _async_request("POST", url, **kwargs)
 
 async def _async_get(url: str, **kwargs):
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, lambda: requests.get(url, **kwargs))
+    return await _async_request("GET", url, **kwargs)
 
 async def _async_put(url: str, **kwargs):
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, lambda: requests.put(url, **kwargs))
+    return await _async_request("PUT", url, **kwargs)
+
+async def _async_patch(url: str, **kwargs):
+    return await _async_request("PATCH", url, **kwargs)
 
 # ---------------- Safe math ----------------
+_MATH_RE = re.compile(r'^[0-9+\-*/().\s]+$')
+_MATH_OPS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+}
+
+def _eval_math(node):
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        return node.value
+    if isinstance(node, ast.BinOp) and type(node.op) in _MATH_OPS:
+        return _MATH_OPS[type(node.op)](_eval_math(node.left), _eval_math(node.right))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _MATH_OPS:
+        return _MATH_OPS[type(node.op)](_eval_math(node.operand))
+    raise ValueError(f"unsupported expression: {ast.dump(node)}")
+
 def safe_math(expr: str):
     if not isinstance(expr, str):
         return None
-    if not re.match(r'^[0-9+\-*/().\s]+$', expr):
+    if not _MATH_RE.match(expr):
         return None
+    stripped = expr.strip()
     try:
-        val = numexpr.evaluate(expr)
-        try:
-            return val.item()
-        except Exception:
-            return float(val)
+        if stripped.isdigit():
+            return int(stripped)
+        return _eval_math(ast.parse(stripped, mode="eval").body)
     except Exception:
         return None
 
 # ---------------- Firebase usage helpers ----------------
+# URL builders, specialised once for the configured database
+_FB_BASE = FIREBASE_DB_URL or ""
+_USAGE_URL = (_FB_BASE + "/usage/{uid}/{day}.json").format
+_LIMIT_URL = (_FB_BASE + "/limits/{uid}/daily.json").format
+_MONTH_TOTAL_URL = (_FB_BASE + "/usage_images/{month}/total_count.json").format
+_ROOT_URL = _FB_BASE + "/.json"
+
+# [valid_until, day_key, month_key], refreshed at local midnight
+_date_cache = [0.0, "", ""]
+
+def _date_keys():
+    if time.time() >= _date_cache[0]:
+        d = datetime.date.today()
+        midnight = datetime.datetime.combine(d + datetime.timedelta(days=1), datetime.time()).timestamp()
+        _date_cache[:] = [midnight, d.isoformat(), f"{d.year}-{d.month:02d}"]
+    return _date_cache
+
 def _today_key():
-    return datetime.date.today().isoformat()
+    return _date_keys()[1]
 
 def _month_key():
-    d = datetime.date.today()
-    return f"{d.year}-{d.month:02d}"
+    return _date_keys()[2]
 
 async def get_usage(user_id: str):
     if not FIREBASE_READY:
         return {"count": 0, "last_ts": 0.0}
-    url = f"{FIREBASE_DB_URL}/usage/{user_id}/{_today_key()}.json"
-    resp = await _async_get(url)
-    if resp.status_code == 200 and resp.json():
-        data = resp.json()
+    url = _USAGE_URL(uid=user_id, day=_today_key())
+    status, data = await _async_get(url)
+    if status == 200 and data:
         return {"count": int(data.get("count", 0)), "last_ts": float(data.get("last_ts", 0.0))}
     return {"count": 0, "last_ts": 0.0}
 
 async def set_usage(user_id: str, count: int, last_ts: float):
     if not FIREBASE_READY:
         return
-    url = f"{FIREBASE_DB_URL}/usage/{user_id}/{_today_key()}.json"
+    url = _USAGE_URL(uid=user_id, day=_today_key())
     await _async_put(url, json={"count": count, "last_ts": last_ts})
 
 async def increment_usage(user_id: str):
     if not FIREBASE_READY:
         return
-    day_count_url = f"{FIREBASE_DB_URL}/usage/{user_id}/{_today_key()}/count.json"
-    resp = await _async_get(day_count_url)
-    cur = int(resp.json()) if resp.status_code == 200 and resp.json() is not None else 0
-    await _async_put(day_count_url, json=cur + 1)
-    ts_url = f"{FIREBASE_DB_URL}/usage/{user_id}/{_today_key()}/last_ts.json"
-    await _async_put(ts_url, json=time.time())
-    month_url = f"{FIREBASE_DB_URL}/usage_images/{_month_key()}/total_count.json"
-    resp2 = await _async_get(month_url)
-    curm = int(resp2.json()) if resp2.status_code == 200 and resp2.json() is not None else 0
-    await _async_put(month_url, json=curm + 1)
+    # Queued here, committed by flush_usage() in one multi-path PATCH
+    day_path = f"usage/{user_id}/{_today_key()}"
+    _pending[f"{day_path}/count"] += 1
+    _pending_ts[f"{day_path}/last_ts"] = time.time()
+    _pending[f"usage_images/{_month_key()}/total_count"] += 1
+
+async def _get_daily_limit_uncached(user_id: str):
+    url = _LIMIT_URL(uid=user_id)
+    status, data = await _async_get(url)
+    if status == 200 and data is not None:
+        return int(data)
+    return DEFAULT_DAILY_LIMIT
+
+# user_id -> (fetched_at, limit), least recently used first
+_LIMIT_CACHE: dict[str, tuple[float, int]] = {}
+LIMIT_CACHE_TTL = 60
+_LIMIT_CACHE_MAX = 10000
+
+def _cache_limit(user_id: str, fetched_at: float, limit: int):
+    _LIMIT_CACHE.pop(user_id, None)
+    if len(_LIMIT_CACHE) >= _LIMIT_CACHE_MAX:
+        del _LIMIT_CACHE[next(iter(_LIMIT_CACHE))]
+    _LIMIT_CACHE[user_id] = (fetched_at, limit)
 
 async def get_daily_limit(user_id: str):
     if not FIREBASE_READY:
         return DEFAULT_DAILY_LIMIT
-    url = f"{FIREBASE_DB_URL}/limits/{user_id}/daily.json"
-    resp = await _async_get(url)
-    if resp.status_code == 200 and resp.json() is not None:
-        return int(resp.json())
-    return DEFAULT_DAILY_LIMIT
+    now = time.time()
+    entry = _LIMIT_CACHE.pop(user_id, None)
+    if entry is not None and now - entry[0] < LIMIT_CACHE_TTL:
+        _LIMIT_CACHE[user_id] = entry
+        return entry[1]
+    limit = await _get_daily_limit_uncached(user_id)
+    # A set_daily_limit that landed during the GET is newer than what we read
+    current = _LIMIT_CACHE.get(user_id)
+    if current is None or current[0] <= now:
+        _cache_limit(user_id, now, limit)
+    return limit
+
+async def set_daily_limit(user_id: str, limit: int):
+    if not FIREBASE_READY:
+        return
+    url = _LIMIT_URL(uid=user_id)
+    status, _ = await _async_put(url, json=int(limit))
+    # Cache only after the write; get_daily_limit won't overwrite this newer entry
+    if status == 200:
+        _cache_limit(user_id, time.time(), int(limit))
+    else:
+        _LIMIT_CACHE.pop(user_id, None)
 
 async def get_monthly_total():
     if not FIREBASE_READY:
         return 0
-    url = f"{FIREBASE_DB_URL}/usage_images/{_month_key()}/total_count.json"
-    resp = await _async_get(url)
-    if resp.status_code == 200 and resp.json() is not None:
-        return int(resp.json())
+    url = _MONTH_TOTAL_URL(month=_month_key())
+    status, data = await _async_get(url)
+    if status == 200 and data is not None:
+        return int(data)
     return 0
 
+async def preflight(user_id: str):
+    # Quota inputs for /image, fetched concurrently: (usage, daily_limit, monthly_total)
+    return await asyncio.gather(get_usage(user_id), get_daily_limit(user_id), get_monthly_total())
+
 async def reset_monthly_total():
     if not FIREBASE_READY:
         return
-    url = f"{FIREBASE_DB_URL}/usage_images/{_month_key()}/total_count.json"
+    url = _MONTH_TOTAL_URL(month=_month_key())
     await _async_put(url, json=0)
 
 async def reset_user_daily(user_id: str):
     if not FIREBASE_READY:
         return
-    url = f"{FIREBASE_DB_URL}/usage/{user_id}/{_today_key()}.json"
+    url = _USAGE_URL(uid=user_id, day=_today_key())
     await _async_put(url, json={"count": 0, "last_ts": 0.0})
 
+# ---------------- Batched usage writer ----------------
+_pending: dict[str, int] = defaultdict(int)
+_pending_ts: dict[str, float] = {}
+_writer_task: asyncio.Task | None = None
+# Retry state for transient flush failures (exceptions, 429, 5xx)
+_flush_failures = 0
+_flush_retry_at = 0.0
+
+async def flush_usage(force: bool = False):
+    global _pending, _pending_ts, _flush_failures, _flush_retry_at
+    if not (_pending or _pending_ts):
+        return
+    if not force and time.time() < _flush_retry_at:
+        return
+    # Swap before the first await so new increments land in the next batch
+    counts, stamps = _pending, _pending_ts
+    _pending, _pending_ts = defaultdict(int), {}
+    updates = {path: {".sv": {"increment": n}} for path, n in counts.items()}
+    updates.update(stamps)
+    items = list(updates.items())
+    chunks = [dict(items[i:i + USAGE_BATCH_MAX_PATHS]) for i in range(0, len(items), USAGE_BATCH_MAX_PATHS)]
+    results = await asyncio.gather(*(_async_patch(_ROOT_URL, json=chunk) for chunk in chunks), return_exceptions=True)
+    retry = False
+    for chunk, result in zip(chunks, results):
+        if isinstance(result, BaseException):
+            logger.error("Usage flush failed, will retry: %s", result)
+        elif result[0] == 429 or result[0] >= 500:
+            logger.error("Usage flush returned HTTP %s, will retry: %s", *result)
+        else:
+            if result[0] != 200:
+                # Permanent rejection (rules, bad path): retrying can't succeed
+                logger.error("Usage flush rejected with HTTP %s, dropping %d paths: %s", result[0], len(chunk), result[1])
+            continue
+        # Put the failed chunk back so a later flush retries it
+        retry = True
+        for path in chunk:
+            if path in counts:
+                _pending[path] += counts[path]
+            else:
+                _pending_ts[path] = max(_pending_ts.get(path, 0.0), stamps[path])
+    if retry:
+        _flush_failures += 1
+        delay = min(USAGE_FLUSH_INTERVAL * 2 ** min(_flush_failures, 10), USAGE_RETRY_MAX_DELAY)
+        _flush_retry_at = time.time() + delay
+    else:
+        _flush_failures = 0
+        _flush_retry_at = 0.0
+
+async def _usage_writer():
+    while True:
+        await asyncio.sleep(USAGE_FLUSH_INTERVAL)
+        try:
+            await flush_usage()
+        except Exception as e:
+            logger.exception("Usage flush failed: %s", e)
+
 # ---------------- Parse image args ----------------
+_SIZE_RE = re.compile(r"--size\s+(512|768|1024)")
+_SEED_RE = re.compile(r"--seed\s+(\d+)")
+_NO_RE = re.compile(r"--no\s+([^\n]+)")
+
 def parse_image_args(args_list):
     text = " ".join(args_list)
     size = None
     seed = None
     negative = None
-    m = re.search(r"--size\s+(512|768|1024)", text)
-    if m:
-        size = m.group(1)
-        text = re.sub(r"--size\s+(512|768|1024)", "", text)
-    m = re.search(r"--seed\s+(\d+)", text)
-    if m:
-        seed = int(m.group(1))
-        text = re.sub(r"--seed\s+\d+", "", text)
-    m = re.search(r"--no\s+([^\n]+)", text)
-    if m:
-        negative = m.group(1).strip()
-        text = re.sub(r"--no\s+[^\n]+", "", text)
+
+    # Each flag is captured (first occurrence wins) and stripped in one pass
+    def take_size(m):
+        nonlocal size
+        if size is None:
+            size = m.group(1)
+        return ""
+
+    def take_seed(m):
+        nonlocal seed
+        if seed is None:
+            seed = int(m.group(1))
+        return ""
+
+    def take_negative(m):
+        nonlocal negative
+        if negative is None:
+            negative = m.group(1).strip()
+        return ""
+
+    text = _SIZE_RE.sub(take_size, text)
+    text = _SEED_RE.sub(take_seed, text)
+    text = _NO_RE.sub(take_negative, text)
     return text.strip(), size, seed, negative
 
 # ---------------- Vertex AI image generation ----------------
 SIZE_MAP = {"512": "512x512", "768": "768x768", "1024": "1024x1024"}
-
+# Prediction fields that may carry the image, in order of preference
+VERTEX_B64_KEYS = ("bytesBase64Encoded", "b64", "imageBytes", "image")
+
+# Payloads larger than this are decoded off the event loop
+B64_OFFLOAD_THRESHOLD = 64 * 1024
+# Decoded chunk by chunk; must stay a multiple of 4
+B64_CHUNK = 64 * 1024
+# Decoded images above this size spill from memory to disk
+IMAGE_SPOOL_MAX = 2 * 1024 * 1024
+
+async def _find_vertex_b64(content):
+    # Stream-parse the response so the raw body is never buffered whole
+    found = {}
+    async for prefix, event, value in ijson.parse_async(content):
+        if prefix == "predictions.item" and event == "end_map":
+            break
+        if event == "string" and prefix.startswith("predictions.item."):
+            key = prefix[len("predictions.item."):]
+            if key in VERTEX_B64_KEYS and value:
+                found[key] = value
+    return next((found[k] for k in VERTEX_B64_KEYS if k in found), None)
+
+def _b64_to_spooled(enc: str):
+    fp = tempfile.SpooledTemporaryFile(max_size=IMAGE_SPOOL_MAX)
+    # Drop whitespace (line-wrapped base64) and carry the remainder over so
+    # every decode call gets a whole number of 4-char groups
+    rest = ""
+    for i in range(0, len(enc), B64_CHUNK):
+        piece = rest + "".join(enc[i:i + B64_CHUNK].split())
+        cut = len(piece) - len(piece) % 4
+        fp.write(pybase64.b64decode(piece[:cut], validate=False))
+        rest = piece[cut:]
+    if rest:
+        fp.write(pybase64.b64decode(rest, validate=False))
+    fp.seek(0)
+    return fp
+
+VERTEX_URL = (
+    f"https://{VERTEX_LOCATION}-aiplatform.googleapis.com/v1/projects/"
+    f"{VERTEX_PROJECT_ID}/locations/{VERTEX_LOCATION}/publishers/google/models/imagegeneration:predict?key={GEMINI_API_KEY}"
+) if (VERTEX_PROJECT_ID and GEMINI_API_KEY and VERTEX_LOCATION) else None
+
+# Returns a rewound SpooledTemporaryFile (not bytes) holding the image, or None
 async def vertex_generate_image(prompt: str, size: str | None = None, seed: int | None = None, negative: str | None = None):
-    if not (VERTEX_PROJECT_ID and GEMINI_API_KEY and VERTEX_LOCATION):
+    if not VERTEX_URL:
         logger.error("Vertex configuration missing")
         return None
-    url = (
-        f"https://{VERTEX_LOCATION}-aiplatform.googleapis.com/v1/projects/"
-        f"{VERTEX_PROJECT_ID}/locations/{VERTEX_LOCATION}/publishers/google/models/imagegeneration:predict?key={GEMINI_API_KEY}"
-    )
     parameters = {"sampleCount": 1, "imageSize": SIZE_MAP.get(size or "1024", "1024x1024")}
     if seed is not None:
         parameters["seed"] = int(seed)
@@ -191,36 +420,38 @@ async def vertex_generate_image(prompt: str, size: str | None = None, seed: int
         parameters["negativePrompt"] = negative
         final_prompt = f"{prompt}. Avoid: {negative}"
     payload = {"instances": [{"prompt": final_prompt}], "parameters": parameters}
-    headers = {"Content-Type": "application/json"}
     try:
-        resp = await _async_post(url, json=payload, headers=headers, timeout=120)
-        resp.raise_for_status()
-        data = resp.json()
-        enc = None
-        if isinstance(data.get("predictions"), list) and data["predictions"]:
-            pred = data["predictions"][0]
-            enc = pred.get("bytesBase64Encoded") or pred.get("b64") or pred.get("imageBytes") or None
-            if not enc:
-                for v in pred.values():
-                    if isinstance(v, str) and len(v) > 100:
-                        enc = v
-                        break
+        async with _async_stream("POST", VERTEX_URL, json=payload) as resp:
+            if resp.status != 200:
+                logger.error("Vertex returned HTTP %s: %s", resp.status, (await resp.read())[:1000])
+                return None
+            enc = await _find_vertex_b64(resp.content)
         if not enc:
-            logger.error("No base64 image in Vertex response: %s", data)
+            logger.error("No base64 image in Vertex response")
             return None
-        return base64.b64decode(enc)
+        if len(enc) > B64_OFFLOAD_THRESHOLD:
+            return await asyncio.to_thread(_b64_to_spooled, enc)
+        return _b64_to_spooled(enc)
     except Exception as e:
         logger.exception("Vertex image generation failed: %s", e)
         return None
 
 # ---------------- Cooldown ----------------
+# In-process timestamps are authoritative; Firebase only gets a batched copy
+_LAST_TS: dict[str, float] = {}
+_LAST_TS_MAX = 10000
+
 async def check_and_update_cooldown(user_id: str):
-    usage = await get_usage(user_id)
     now = time.time()
-    last = usage.get("last_ts", 0.0)
-    if now - last < COOLDOWN_SECONDS:
+    if now - _LAST_TS.get(user_id, 0.0) < COOLDOWN_SECONDS:
         return False
-    await set_usage(user_id, usage.get("count", 0), now)
+    if len(_LAST_TS) >= _LAST_TS_MAX:
+        cutoff = now - COOLDOWN_SECONDS
+        for uid in [uid for uid, ts in _LAST_TS.items() if ts < cutoff]:
+            del _LAST_TS[uid]
+    _LAST_TS[user_id] = now
+    if FIREBASE_READY:
+        _pending_ts[f"usage/{user_id}/{_today_key()}/last_ts"] = now
     return True
 
 # ---------------- Admin helper ----------------
@@ -245,7 +476,25 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 app = Flask(__name__)
 application = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
 
+WARM_TIMEOUT = aiohttp.ClientTimeout(total=5)
+_warm_task: asyncio.Task | None = None
+
+async def _warm_connections():
+    # Pay DNS + TLS for Firebase and Vertex up front so the pool has live sockets
+    session = await _session()
+
+    async def head(url):
+        async with session.head(url, timeout=WARM_TIMEOUT) as resp:
+            return resp.status
+
+    urls = [u for u in (_ROOT_URL + "?shallow=true" if FIREBASE_READY else None, VERTEX_URL) if u]
+    await asyncio.gather(*(head(u) for u in urls), return_exceptions=True)
+
 async def post_init(apply):
+    global _writer_task, _warm_task
+    _writer_task = asyncio.create_task(_usage_writer())
+    # Not awaited: the first update must not wait on the warm-up requests
+    _warm_task = asyncio.create_task(_warm_connections())
     await apply.bot.set_my_commands([
         BotCommand("help", "Show help"),
         BotCommand("ask", "Ask AI"),
@@ -253,7 +502,56 @@ async def post_init(apply):
         BotCommand("image", "Generate AI image"),
         BotCommand("quota", "Show usage"),
     ])
+
+async def post_shutdown(apply):
+    for task in (_writer_task, _warm_task):
+        if task is not None:
+            task.cancel()
+    if _warm_task is not None:
+        # Let the cancelled HEADs unwind before the session is closed
+        await asyncio.gather(_warm_task, return_exceptions=True)
+    await flush_usage(force=True)
+
 application.post_init = post_init
+application.post_shutdown = post_shutdown
+
+# ---------------- Persistent event loop ----------------
+# One loop for the whole process so the aiohttp pool and background tasks
+# survive between webhook calls
+LOOP = asyncio.new_event_loop()
+threading.Thread(target=LOOP.run_forever, name="bot-loop", daemon=True).start()
+
+async def _startup():
+    try:
+        await application.initialize()
+        await post_init(application)
+    except Exception as e:
+        logger.exception("Bot startup failed: %s", e)
+
+async def _shutdown():
+    try:
+        await post_shutdown(application)
+        await application.shutdown()
+    finally:
+        if _SESSION is not None:
+            await _SESSION.close()
+
+def _stop_loop():
+    try:
+        asyncio.run_coroutine_threadsafe(_shutdown(), LOOP).result(timeout=10)
+    except Exception as e:
+        logger.exception("Bot shutdown failed: %s", e)
+    LOOP.call_soon_threadsafe(LOOP.stop)
+
+_STARTUP = asyncio.run_coroutine_threadsafe(_startup(), LOOP)
+atexit.register(_stop_loop)
+
+async def _handle_update(update_data):
+    try:
+        await application.process_update(Update.de_json(update_data, application.bot))
+    finally:
+        # Serverless instances can be frozen right after the response
+        await flush_usage()
 
 @app.get("/")
 def health():
@@ -265,9 +563,15 @@ def webhook():
         update_data = flask_request.get_json(force=True, silent=True)
         if not update_data:
             return "no data", 400
-        async def main_async():
-            await application.process_update(Update.de_json(update_data, application.bot))
-        asyncio.run(main_async())
+        _STARTUP.result(timeout=STARTUP_TIMEOUT)
+        fut = asyncio.run_coroutine_threadsafe(_handle_update(update_data), LOOP)
+        try:
+            fut.result(timeout=WEBHOOK_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            # The instance may be frozen after we respond, so don't leave work running.
+            # Acknowledge anyway: a 500 would make Telegram resend and repeat the work.
+            fut.cancel()
+            logger.error("Update exceeded %ss and was dropped", WEBHOOK_TIMEOUT)
         return "ok"
     except Exception as e:
         logger.exception("Webhook failed: %s", e)